@@ -13,6 +13,13 @@ def get_parms(dataset):
     parser.add_argument("--round", type=int, default=10001, help="Communication rounds")
     parser.add_argument("--q", type=float, default=1, help="Probability of snapshot")
     parser.add_argument("--f", type=int, default=50, help="The q in the GA algorithm")
+    parser.add_argument(
+        "--sketch",
+        type=str,
+        default="gaussian",
+        choices=["gaussian", "countsketch"],
+        help="[gaussian, countsketch]",
+    )
     parser.add_argument(
         "--gamma", type=float, default=0.7, help="parameter for adaptive FAST"
     )
@@ -36,6 +43,30 @@ def get_parms(dataset):
     )
     parser.add_argument("--log-to-tensorboard", type=str, default=None)
     parser.add_argument("--eval-iterations", type=int, default=10)
+    parser.add_argument(
+        "--debug-mse",
+        action="store_true",
+        default=False,
+        help="print the sketch reconstruction MSE of each client",
+    )
+    parser.add_argument(
+        "--tf32",
+        action="store_true",
+        default=False,
+        help="allow TF32 for fp32 matmuls and convolutions",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="run the CUDA models through torch.compile",
+    )
+    parser.add_argument(
+        "--fuse-eval",
+        action="store_true",
+        default=False,
+        help="fold BatchNorm and drop Dropout layers for evaluation",
+    )
     parser.add_argument(
         "--no-cuda", action="store_true", default=False, help="disables CUDA training"
     )
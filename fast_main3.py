@@ -32,6 +32,11 @@ device_2 = torch.device(f'cuda:{gpus[1]}')  # Second GPU
 
 args = get_parms("MNIST").parse_args()
 torch.manual_seed(args.seed)
+if args.tf32:
+    # Process-wide, so set once here; the bf16 sketch GEMMs are unaffected.
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 train_dataset, test_loader, device = preprocess.preprocess(args)
 
 if args.dataset == "mnist":
@@ -109,6 +114,9 @@ for idx in range(args.num_clients):
             DatasetSplit(train_dataset, dict_users[idx]),
             batch_size=args.train_batch_size,
             shuffle=True,
+            # Batches are loaded in the main process: a worker pool per client
+            # would spawn num_clients * num_workers processes.
+            pin_memory=True,
         )
         
         server = Server(model=cnn.CNN_Cifar10_2(), 
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
 
 class CNN_Mnist(nn.Module):
@@ -14,12 +13,12 @@ class CNN_Mnist(nn.Module):
                 stride=1,
                 padding=2,
             ),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(kernel_size=2),
         )
         self.conv2 = nn.Sequential(
             nn.Conv2d(16, 32, 5, 1, 2),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.MaxPool2d(2),
         )
         # fully connected layer, output 10 classes
@@ -29,7 +28,7 @@ class CNN_Mnist(nn.Module):
         x = self.conv1(x)
         x = self.conv2(x)
         # flatten the output of conv2 to (batch_size, 32 * 7 * 7)
-        x = x.view(x.size(0), -1)
+        x = x.flatten(1)
         output = self.out(x)
         return output
 
@@ -89,105 +88,127 @@ class CNN_Cifar10_1(nn.Module):
             nn.Dropout(p=0.1),
             nn.Linear(512, 10),
         )
+        # NHWC lets cuDNN pick its tensor-core conv kernels.
+        self.to(memory_format=torch.channels_last)
+
+    @torch.no_grad()
+    def fuse_bn(self, src=None):
+        # Fold each BatchNorm2d into the Conv2d right before it (eval only).
+        # With src, refold src's current weights into this fused copy in place.
+        src = self if src is None else src
+        for i in range(1, len(src.conv_layer)):
+            conv, bn = src.conv_layer[i - 1], src.conv_layer[i]
+            if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+                continue
+            c = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            bias = conv.bias if conv.bias is not None else torch.zeros_like(c)
+            bias = (bias - bn.running_mean) * c + bn.bias
+            fused = self.conv_layer[i - 1]
+            fused.weight.copy_(conv.weight * c[:, None, None, None])
+            if fused.bias is None:
+                fused.bias = nn.Parameter(bias)
+            else:
+                fused.bias.copy_(bias)
+            self.conv_layer[i] = nn.Identity()
+        return self
+
+    @torch.no_grad()
+    def refresh_fused(self, src):
+        # Update a fuse_eval() copy in place from the training model src.
+        src_params = dict(src.named_parameters())
+        for name, p in self.named_parameters():
+            p.copy_(src_params[name])
+        return self.fuse_bn(src)
+
+    def fuse_eval(self):
+        # Inference only: fold BatchNorm and replace Dropout with Identity.
+        self.fuse_bn()
+        for layers in (self.conv_layer, self.fc_layer):
+            for i, layer in enumerate(layers):
+                if isinstance(layer, (nn.Dropout, nn.Dropout2d)):
+                    layers[i] = nn.Identity()
+        return self
 
     def forward(self, x):
         x = self.conv_layer(x)
-        x = x.view(x.size(0), -1)
+        x = x.flatten(1)
         x = self.fc_layer(x)
-        x = F.log_softmax(x, dim=1)
+        # Raw logits; nn.CrossEntropyLoss applies log_softmax itself.
         return x
 
 
 class CNN_Cifar10_2(nn.Module):
     def __init__(self):
         super(CNN_Cifar10_2, self).__init__()
-        # convolutional layer (sees 32x32x3 image tensor)
-        self.conv1 = nn.Conv2d(3, 16, 3, padding=1)
-        # convolutional layer (sees 16x16x16 tensor)
-        self.conv2 = nn.Conv2d(16, 32, 3, padding=1)
-        # convolutional layer (sees 8x8x32 tensor)
-        self.conv3 = nn.Conv2d(32, 64, 3, padding=1)
-        # max pooling layer
-        self.pool = nn.MaxPool2d(2, 2)
-        # linear layer (64 * 4 * 4 -> 500)
-        self.fc1 = nn.Linear(64 * 4 * 4, 500)
-        # linear layer (500 -> 10)
-        self.fc2 = nn.Linear(500, 10)
-        # dropout layer (p=0.25)
-        self.dropout = nn.Dropout(0.25)
+        self.features = nn.Sequential(
+            # convolutional layer (sees 32x32x3 image tensor)
+            nn.Conv2d(3, 16, 3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+            # convolutional layer (sees 16x16x16 tensor)
+            nn.Conv2d(16, 32, 3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+            # convolutional layer (sees 8x8x32 tensor)
+            nn.Conv2d(32, 64, 3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+        )
+        self.classifier = nn.Sequential(
+            # dropout layer (p=0.25)
+            nn.Dropout(0.25),
+            # linear layer (64 * 4 * 4 -> 500)
+            nn.Linear(64 * 4 * 4, 500),
+            nn.ReLU(inplace=True),
+            nn.Dropout(0.25),
+            # linear layer (500 -> 10)
+            nn.Linear(500, 10),
+        )
+        # NHWC lets cuDNN pick its tensor-core conv kernels.
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x):
-        # add sequence of convolutional and max pooling layers
-        x = self.pool(F.relu(self.conv1(x)))
-        x = self.pool(F.relu(self.conv2(x)))
-        x = self.pool(F.relu(self.conv3(x)))
-        # flatten image input
-        x = x.view(-1, 64 * 4 * 4)
-        # add dropout layer
-        x = self.dropout(x)
-        # add 1st hidden layer, with relu activation function
-        x = F.relu(self.fc1(x))
-        # add dropout layer
-        x = self.dropout(x)
-        # add 2nd hidden layer, with relu activation function
-        x = self.fc2(x)
-        return x
+        return self.classifier(self.features(x).flatten(1))
 
 class deepCNN_Cifar10(nn.Module):
     def __init__(self):
         super(deepCNN_Cifar10, self).__init__()
-        # First block of convolutional layers
-        self.conv1 = nn.Conv2d(3, 32, kernel_size=3, padding=1)
-        self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1)
-        self.pool1 = nn.MaxPool2d(2, 2)
-        self.drop1 = nn.Dropout2d(p=0.2)
-
-        # Second block of convolutional layers
-        self.conv3 = nn.Conv2d(64, 128, kernel_size=3, padding=1)
-        self.conv4 = nn.Conv2d(128, 128, kernel_size=3, padding=1)
-        self.pool2 = nn.MaxPool2d(2, 2)
-        self.drop2 = nn.Dropout2d(p=0.3)
-
-        # Third block of convolutional layers
-        self.conv5 = nn.Conv2d(128, 256, kernel_size=3, padding=1)
-        self.conv6 = nn.Conv2d(256, 256, kernel_size=3, padding=1)
-        self.pool3 = nn.MaxPool2d(2, 2)
-        self.drop3 = nn.Dropout2d(p=0.4)
-
+        self.features = nn.Sequential(
+            # First block of convolutional layers
+            nn.Conv2d(3, 32, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+            nn.Dropout2d(p=0.2),
+            # Second block of convolutional layers
+            nn.Conv2d(64, 128, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(128, 128, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+            nn.Dropout2d(p=0.3),
+            # Third block of convolutional layers
+            nn.Conv2d(128, 256, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(256, 256, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+            nn.Dropout2d(p=0.4),
+        )
         # Fully connected layers
-        self.fc1 = nn.Linear(256 * 4 * 4, 1024)
-        self.fc2 = nn.Linear(1024, 512)
-        self.fc3 = nn.Linear(512, 10)
-
+        self.classifier = nn.Sequential(
+            nn.Linear(256 * 4 * 4, 1024),
+            nn.ReLU(inplace=True),
+            nn.Linear(1024, 512),
+            nn.ReLU(inplace=True),
+            nn.Linear(512, 10),
+        )
+        # NHWC lets cuDNN pick its tensor-core conv kernels.
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x):
-        # First block
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
-        x = self.pool1(x)
-        x = self.drop1(x)
-
-        # Second block
-        x = F.relu(self.conv3(x))
-        x = F.relu(self.conv4(x))
-        x = self.pool2(x)
-        x = self.drop2(x)
-
-        # Third block
-        x = F.relu(self.conv5(x))
-        x = F.relu(self.conv6(x))
-        x = self.pool3(x)
-        x = self.drop3(x)
-
-        # Flatten the tensor
-        x = x.view(-1, 256 * 4 * 4)
-
-        # Fully connected layers
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
-        x = self.fc3(x)
-
-        return x
+        return self.classifier(self.features(x).flatten(1))
 
 
 class CNN_FMNIST(nn.Module):
@@ -201,7 +222,7 @@ class CNN_FMNIST(nn.Module):
         self.linear_1 = nn.Linear(9216, 128)
         self.dropout_2 = nn.Dropout(0.5)
         self.linear_2 = nn.Linear(128, 10 if only_digits else 62)
-        self.relu = nn.ReLU()
+        self.relu = nn.ReLU(inplace=True)
 
     def forward(self, x):
         x = self.conv2d_1(x)
@@ -238,7 +259,7 @@ class CNN_FEMNIST(nn.Module):
         self.linear_1 = nn.Linear(9216, 128)
         self.dropout_2 = nn.Dropout(0.5)
         self.linear_2 = nn.Linear(128, 10 if only_digits else 62)
-        self.relu = nn.ReLU()
+        self.relu = nn.ReLU(inplace=True)
         # self.softmax = nn.Softmax(dim=1)
 
     def forward(self, x):
@@ -1,36 +1,58 @@
+import copy
+import weakref
 import torch
 import numpy as np
 import random
 from torch.utils.data import Dataset
 from config import get_parms
 from shared.compression import quantize, dequantize_tensor, top_k, random_k
+from shared.dataset import label_buckets
 
 args = get_parms("utils").parse_args()
 
 
-def generate_gaussian_matrix(d: int, 
-                             f: int = args.f, 
-                             chunk_size: int = 1, 
-                             device="cpu") -> torch.Tensor:
-    G = torch.empty(d, f, device=device)
-    for i in range(0, d, chunk_size):
-        end_idx = min(i + chunk_size, d)
-        G[i:end_idx, :] = torch.randn(end_idx - i, f, device=device)
-    return G
+def new_sketch_seed() -> int:
+    return int(torch.randint(0, 2**31, (1,)))
 
 
-def get_approx_optimal_weights(G: torch.Tensor, 
+def gaussian_blocks(seed: int, 
+                    d: int, 
+                    f: int = args.f, 
+                    block_size: int = None, 
+                    dtype: torch.dtype = torch.bfloat16, 
+                    device="cpu"):
+    # Regenerate G row block by row block from (seed, block index) into one
+    # reusable buffer, so the full d x f matrix never has to be stored.
+    # bf16 halves the bytes streamed from G; a Gaussian sketch does not need more.
+    if block_size is None:
+        # About 2**24 entries of G per block, whatever f is.
+        block_size = max(1, 2**24 // f)
+    buf = torch.empty(min(block_size, d), f, device=device, dtype=dtype)
+    gen = torch.Generator(device=device)
+    for block_idx, start in enumerate(range(0, d, block_size)):
+        end_idx = min(start + block_size, d)
+        gen.manual_seed(seed + block_idx * 2**31)
+        yield start, end_idx, buf[: end_idx - start].normal_(generator=gen)
+
+
+def get_approx_optimal_weights(G_seed: int, 
                                delta: torch.Tensor, 
-                               f: int = args.f, 
-                               chunk_size: int = 1000) -> torch.Tensor:
-    delta = delta.to(G.device)
-    w = torch.zeros(f, device=G.device)
-    d = G.size(0)
-    for i in range(0, d, chunk_size):
-        end_idx = min(i + chunk_size, d)
-        G_chunk = G[i:end_idx, :]
-        w += G_chunk.T @ delta[i:end_idx] / f
-    return w
+                               f: int = args.f) -> torch.Tensor:
+    # delta may be a single (d,) vector or a (d, C) stack of client deltas.
+    w = torch.zeros(f, *delta.shape[1:], device=delta.device)
+    for start, end_idx, G_block in gaussian_blocks(G_seed, delta.size(0), f, device=delta.device):
+        w += (G_block.T @ delta[start:end_idx].to(G_block.dtype)).float()
+    return w.div_(f)
+
+
+def get_sketch_reconstruction(G_seed: int, 
+                              w: torch.Tensor, 
+                              d: int, 
+                              f: int = args.f) -> torch.Tensor:
+    Gw = torch.empty(d, *w.shape[1:], device=w.device)
+    for start, end_idx, G_block in gaussian_blocks(G_seed, d, f, device=w.device):
+        Gw[start:end_idx] = G_block @ w.to(G_block.dtype)
+    return Gw
 
 
 def set_all_param_zero(model):
@@ -39,37 +61,149 @@ def set_all_param_zero(model):
             p.zero_()
 
 
+def flat_view(x_flattern, start, p):
+    # View of p's slice of a flat buffer with p's own strides. The flat layout
+    # follows each param's memory order, so channels_last weights stay so.
+    return x_flattern[start : (start + p.numel())].as_strided(p.size(), p.stride())
+
+
 def set_flatten_model_back(model, x_flattern):
     with torch.no_grad():
         start = 0
         for p in model.parameters():
             if not p.requires_grad:
                 continue
-            p_extract = x_flattern[start : (start + p.numel())]
-            p.set_(p_extract.view(p.shape).clone())
+            # Write into the existing storage so optimizer state stays attached.
+            p.copy_(flat_view(x_flattern, start, p))
             if p.grad is not None:
                 p.grad.zero_()
             start += p.numel()
 
 
+def flatten_tensors(params, tensors) -> torch.Tensor:
+    # Flatten tensors shaped like params, in the memory order of params.
+    flat = torch.empty(sum(p.numel() for p in params), device=params[0].device)
+    start = 0
+    for p, t in zip(params, tensors):
+        flat_view(flat, start, p).copy_(t)
+        start += p.numel()
+    return flat
+
+
 def get_flatten_model_param(model):
     with torch.no_grad():
-        return torch.cat(
-            [p.detach().view(-1) for p in model.parameters() if p.requires_grad]
-        )
+        params = [p for p in model.parameters() if p.requires_grad]
+        return flatten_tensors(params, params)
+
+
+def bind_flatten_model_storage(model) -> tuple[torch.Tensor, torch.Tensor]:
+    # Rebind every trainable param and grad to a view into one flat buffer,
+    # so flattening the model needs no torch.cat.
+    params = [p for p in model.parameters() if p.requires_grad]
+    flat_params = get_flatten_model_param(model)
+    flat_grads = torch.zeros_like(flat_params)
+    start = 0
+    for p in params:
+        # Keep p's strides, e.g. channels_last conv weights.
+        p.data = flat_view(flat_params, start, p)
+        p.grad = flat_view(flat_grads, start, p)
+        start += p.numel()
+    return flat_params, flat_grads
 
 
 def get_flatten_model_grad(model) -> torch.Tensor:
     with torch.no_grad():
-        return torch.cat(
-            [p.grad.detach().view(-1) for p in model.parameters() if p.requires_grad]
+        params = [p for p in model.parameters() if p.requires_grad]
+        return flatten_tensors(params, [p.grad for p in params])
+
+
+def compile_model(model, device, mode="default"):
+    # Only compile for CUDA with --compile; otherwise keep the eager model.
+    if not args.compile or torch.device(device).type != "cuda":
+        return model
+    # Trace params as graph inputs so every Agent of one architecture shares
+    # a single Dynamo graph instead of compiling once per instance.
+    torch._dynamo.config.inline_inbuilt_nn_modules = True
+    return torch.compile(model, mode=mode)
+
+
+_fused_eval_cache = weakref.WeakKeyDictionary()
+
+
+def get_eval_model(model):
+    # The fused copy is built and compiled once per model, then only refreshed
+    # in place from the current weights. torch.compile wraps the model as _orig_mod.
+    model_to_fuse = getattr(model, "_orig_mod", model)
+    if not (args.fuse_eval and hasattr(model_to_fuse, "fuse_eval")):
+        return model
+    if model_to_fuse not in _fused_eval_cache:
+        # Fuse a copy so the flattened parameter layout used in training is kept.
+        fused = copy.deepcopy(model_to_fuse).fuse_eval()
+        device = next(fused.parameters()).device
+        _fused_eval_cache[model_to_fuse] = (fused, compile_model(fused, device))
+    else:
+        _fused_eval_cache[model_to_fuse][0].refresh_fused(model_to_fuse)
+    return _fused_eval_cache[model_to_fuse][1]
+
+
+def to_device(inputs, device, non_blocking=False):
+    # Image batches go channels_last to match the conv models' memory format.
+    if inputs.dim() == 4:
+        return inputs.to(
+            device, memory_format=torch.channels_last, non_blocking=non_blocking
         )
+    return inputs.to(device, non_blocking=non_blocking)
+
+
+class CUDAPrefetcher:
+    # Copies the next batch to the GPU on a side stream while the current
+    # one is being trained on. Use with a pin_memory=True DataLoader so the
+    # non_blocking copies are actually asynchronous. The loader is only
+    # iterated from the first next(), so building an Agent holds no batch.
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.batch_idx = -1
+        self.next_batch = None
+
+    def preload(self):
+        try:
+            inputs, targets = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = (
+                to_device(inputs, self.device, non_blocking=True),
+                targets.to(self.device, non_blocking=True),
+            )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch_idx == -1:
+            self.loader = iter(self.loader)
+            self.preload()
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        inputs, targets = self.next_batch
+        # The tensors were allocated on the side stream but are used here.
+        inputs.record_stream(current_stream)
+        targets.record_stream(current_stream)
+        self.batch_idx += 1
+        self.preload()
+        return self.batch_idx, (inputs, targets)
 
 
 def accuracy(output, target):
     # get the index of the max log-probability
     pred = output.data.max(1, keepdim=True)[1]
-    return pred.eq(target.data.view_as(pred)).cpu().float().mean()
+    # Stay on the device; Metric only syncs when the average is read.
+    return pred.eq(target.data.view_as(pred)).float().mean()
 
 
 class Metric(object):
@@ -80,14 +214,15 @@ class Metric(object):
 
     def update(self, val):
         if isinstance(val, torch.Tensor):
-            self.sum += val.detach().cpu()
+            self.sum = self.sum + val.detach()
         else:
             self.sum += val
         self.n += 1
 
     @property
     def avg(self):
-        return self.sum / self.n
+        avg = self.sum / self.n
+        return avg.item() if isinstance(avg, torch.Tensor) else avg
 
 
 class Agent:
@@ -103,15 +238,27 @@ class Agent:
         self.batch_idx = 0
         self.epoch = 0
         self.data_generator = self.get_one_train_batch()
-        self.model_grad = torch.zeros_like(get_flatten_model_param(self.model))
-        self.G = torch.zeros_like(get_flatten_model_param(self.model)).to(self.device)
+        self._flat_params, self._flat_grads = bind_flatten_model_storage(self.model)
+        # fp16 mixed precision is only used on CUDA devices.
+        self.use_amp = torch.device(device).type == "cuda"
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp)
+        self._grad_sum = torch.zeros((), device=device)
+        # No reduce-overhead: its CUDA graphs are recorded per param address,
+        # i.e. once per Agent.
+        self.model = compile_model(self.model, device)
+        # Only the sketched fedavg aggregation reads the accumulated gradient.
+        self.model_grad = (
+            torch.zeros_like(self._flat_params) if args.algo == "fedavg" else None
+        )
+        self.G_seed = None
 
     def pull_G(self, server):
-        self.G = server.G
+        self.G_seed = server.G_seed
 
     def get_one_train_batch(self):
-        for batch_idx, (inputs, targets) in enumerate(self.train_loader):
-            yield batch_idx, (inputs, targets)
+        if torch.device(self.device).type == "cuda":
+            return CUDAPrefetcher(self.train_loader, self.device)
+        return enumerate(self.train_loader)
 
     def reset_epoch(self):
         self.data_generator = self.get_one_train_batch()
@@ -122,15 +269,8 @@ class Agent:
 
     def pull_model_from_server(self, server):
         # print("pull_model_from_server")
-        if self.device != "cpu":
-            # Notice the device between server and client may be different.
-            with torch.device(self.device):
-                # This context manager is necessary for the clone operation.
-                set_flatten_model_back(
-                    self.model, server.flatten_params.to(self.device)
-                )
-        else:
-            set_flatten_model_back(self.model, server.flatten_params)
+        # copy_ handles the server and client living on different devices.
+        set_flatten_model_back(self.model, server.flatten_params)
 
     def decay_lr_in_optimizer(self, gamma: float):
         for g in self.optimizer.param_groups:
@@ -138,8 +278,9 @@ class Agent:
 
     def train_k_step_fedavg(self, k: int):
         self.model.train()
-        # Initialize an empty gradient tensor
-        self.model_grad = torch.zeros_like(get_flatten_model_param(self.model))
+        # Reset the gradient accumulator in place
+        if self.model_grad is not None:
+            self.model_grad.zero_()
         for i in range(k):
             try:
                 batch_idx, (inputs, targets) = next(self.data_generator)
@@ -147,28 +288,43 @@ class Agent:
                 loss, acc = self.train_loss.avg, self.train_accuracy.avg
                 self.reset_epoch()
                 return loss, acc
-            inputs, targets = inputs.to(self.device), targets.to(self.device)
-            self.model.zero_grad()
-            outputs = self.model(inputs)
-            loss = self.criterion(outputs, targets)
-            loss.backward()
+            inputs, targets = to_device(inputs, self.device), targets.to(self.device)
+            # zero_grad() would set the grads to None and drop the flat views.
+            self._flat_grads.zero_()
+            with torch.autocast(
+                device_type="cuda", dtype=torch.float16, enabled=self.use_amp
+            ):
+                outputs = self.model(inputs)
+                loss = self.criterion(outputs, targets)
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.optimizer)
             # Get the gradient and add it to model_grad
-            self.model_grad += get_flatten_model_grad(self.model)
-
-            self.optimizer.step()
-            self.train_loss.update(loss.item())
-            self.train_accuracy.update(accuracy(outputs, targets).item())
+            if self.model_grad is not None:
+                grads = self._flat_grads
+                if self.use_amp:
+                    # The scaler skips steps with inf/nan grads; skip them here too.
+                    # Any inf/nan makes the sum non-finite; reduce into a 0-d buffer
+                    # and zero the flat grads in place instead of a masked copy.
+                    torch.sum(grads, dim=0, out=self._grad_sum)
+                    torch.where(torch.isfinite(self._grad_sum), grads, 0.0, out=grads)
+                self.model_grad.add_(grads)
+
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.train_loss.update(loss)
+            self.train_accuracy.update(accuracy(outputs, targets))
         return self.train_loss.avg, self.train_accuracy.avg
 
     def eval(self, test_dataloader) -> tuple[float, float]:
         self.model.eval()
+        model = get_eval_model(self.model)
         val_accuracy = Metric("val_accuracy")
         val_loss = Metric("val_loss")
         for batch_idx, (inputs, targets) in enumerate(test_dataloader):
-            inputs, targets = inputs.to(self.device), targets.to(self.device)
-            outputs = self.model(inputs)
-            val_accuracy.update(accuracy(outputs, targets).item())
-            val_loss.update(self.criterion(outputs, targets).item())
+            inputs, targets = to_device(inputs, self.device), targets.to(self.device)
+            outputs = model(inputs)
+            val_accuracy.update(accuracy(outputs, targets))
+            val_loss.update(self.criterion(outputs, targets))
         return val_loss.avg, val_accuracy.avg
 
 
@@ -185,38 +341,40 @@ class Server:
     def __init__(self, *, model, criterion, device):
         self.model = model.to(device)
         self.flatten_params = get_flatten_model_param(self.model).to(device)
+        # The server only runs eval, where input shapes are static.
+        self.model = compile_model(self.model, device, mode="max-autotune")
         self.criterion = criterion
         self.device = device
         self.num_arb_participation = 0
         self.num_uni_participation = 0
         self.momentum = self.flatten_params.clone().zero_()
-        self.G = generate_gaussian_matrix(
-            get_flatten_model_param(self.model).size(0)
-        ).to(device)
+        self.d = self.flatten_params.size(0)
+        self.G_seed = new_sketch_seed() if args.algo == "fedavg" else None
 
     def avg_clients(self, clients: list[Agent], weights=0):
         if args.algo == "fedavg":
-            for client in clients:
-                delta = client.model_grad
-                Gw = self.G @ get_approx_optimal_weights(G=self.G, 
-                                                         delta=client.model_grad).to(self.device)
-                mse = torch.mean((delta - Gw) ** 2)
-                print('MSE:', mse)
-                self.flatten_params -= Gw.mul_(args.lr / len(clients))
+            # Stack the client deltas so G is streamed twice per round in total.
+            delta = torch.stack(
+                [client.model_grad for client in clients], dim=1
+            ).to(self.device)
+            w = get_approx_optimal_weights(G_seed=self.G_seed, delta=delta)
+            Gw = get_sketch_reconstruction(G_seed=self.G_seed, w=w, d=self.d)
+            if args.debug_mse:
+                print('MSE:', torch.mean((delta - Gw) ** 2, dim=0))
+            self.flatten_params -= Gw.sum(dim=1).mul_(args.lr / len(clients))
             set_flatten_model_back(self.model, self.flatten_params)
-        self.G = generate_gaussian_matrix(
-            get_flatten_model_param(self.model).size(0)
-        ).to(self.device)
+            self.G_seed = new_sketch_seed()
 
     def eval(self, test_dataloader) -> tuple[float, float]:
         self.model.eval()
+        model = get_eval_model(self.model)
         val_accuracy = Metric("val_accuracy")
         val_loss = Metric("val_loss")
         for batch_idx, (inputs, targets) in enumerate(test_dataloader):
-            inputs, targets = inputs.to(self.device), targets.to(self.device)
-            outputs = self.model(inputs)
-            val_accuracy.update(accuracy(outputs, targets).item())
-            val_loss.update(self.criterion(outputs, targets).item())
+            inputs, targets = to_device(inputs, self.device), targets.to(self.device)
+            outputs = model(inputs)
+            val_accuracy.update(accuracy(outputs, targets))
+            val_loss.update(self.criterion(outputs, targets))
         return val_loss.avg, val_accuracy.avg
 
     # Determine the sampling method by q
@@ -234,15 +392,21 @@ class Server:
 class DatasetSplit(Dataset):
     def __init__(self, dataset, idxs):
         self.dataset = dataset
-        self.idxs = list(idxs)
+        # An int64 array pickles to DataLoader workers far cheaper than a list.
+        self.idxs = np.asarray(list(idxs), dtype=np.int64)
 
     def __len__(self):
         return len(self.idxs)
 
     def __getitem__(self, item):
-        image, label = self.dataset[self.idxs[item]]
+        image, label = self.dataset[int(self.idxs[item])]
         return image, label
 
+    def __getitems__(self, indices):
+        # Batched fetch used by DataLoader (torch >= 2.0) in place of one
+        # __getitem__ call per sample.
+        return [self.dataset[int(i)] for i in self.idxs[indices]]
+
 
 def partition(dataset, n_nodes, data_dirichlet_alpha):
     dict_users = {i: np.array([], dtype="int64") for i in range(n_nodes)}
@@ -261,9 +425,7 @@ def partition(dataset, n_nodes, data_dirichlet_alpha):
     )
     sum_prob_per_label = np.sum(label_distributions_each_node, axis=0)
 
-    indices_per_label = []
-    for i in range(min_label, max_label + 1):
-        indices_per_label.append([j for j in range(len(labels)) if labels[j] == i])
+    indices_per_label = label_buckets(dataset, labels, min_label, max_label)
 
     start_index_per_label = np.zeros(num_labels, dtype="int64")
     for n in range(n_nodes):
@@ -288,13 +450,7 @@ def partition(dataset, n_nodes, data_dirichlet_alpha):
             start_index_per_label[i] = end_index
 
     actual_label_distributions_each_node = [
-        np.array(
-            [
-                len([j for j in labels[dict_users[n]] if j == i])
-                for i in range(min_label, max_label + 1)
-            ],
-            dtype="int64",
-        )
+        np.bincount(labels[dict_users[n]] - min_label, minlength=num_labels)
         / len(dict_users[n])
         for n in range(n_nodes)
     ]
@@ -1,29 +1,77 @@
+import weakref
 import torch
+import torch.nn.functional as F
 import numpy as np
 import random
 from torch.utils.data import Dataset
 from config import get_parms
 from shared.compression import quantize, dequantize_tensor, top_k, random_k
+from shared.dataset import label_buckets
 
 args = get_parms("utils").parse_args()
 
 
 def generate_gaussian_matrix(d: int, 
                              f: int = args.f, 
-                             device: torch.device = torch.device('cpu')) -> torch.Tensor:
-    G = torch.randn(d, f//2, device=device)  # Create the tensor directly on the specified device
-    return G
+                             device: torch.device = torch.device('cpu'), 
+                             generator: torch.Generator = None) -> torch.Tensor:
+    # bf16 halves the bytes read from G; a Gaussian sketch tolerates the precision loss
+    G = torch.empty(d, f//2, device=device, dtype=torch.bfloat16)  # Create the tensor directly on the specified device
+    return G.normal_(generator=generator)
+
+class CountSketch:
+    # Sparse stand-in for one d x f/2 Gaussian G: every coordinate is hashed to
+    # one of f // parts buckets with a random sign, so sketching is a single
+    # scatter_add and reconstruction a single gather instead of dense GEMMs.
+    # Each of the `parts` sketches is unbiased, so reconstruction divides by
+    # parts to keep the sum over devices unbiased.
+    def __init__(self, d: int, 
+                 f: int = args.f, 
+                 parts: int = 2, 
+                 device: torch.device = torch.device('cpu'), 
+                 generator: torch.Generator = None):
+        self.buckets = f // parts
+        self.parts = parts
+        self.generator = generator
+        self.hash = torch.empty(d, dtype=torch.int64, device=device)
+        self.sign = torch.empty(d, dtype=torch.int8, device=device)
+        self.redraw()
+
+    def redraw(self):
+        self.hash.random_(0, self.buckets, generator=self.generator)
+        self.sign.random_(0, 2, generator=self.generator).mul_(2).sub_(1)
+
+    def sketch(self, delta: torch.Tensor) -> torch.Tensor:
+        # delta may be a single (d,) vector or a (d, C) stack of client deltas.
+        index, sign = self.hash, self.sign
+        if delta.dim() == 2:
+            index, sign = index[:, None].expand_as(delta), sign[:, None]
+        w = torch.zeros(self.buckets, *delta.shape[1:], device=delta.device)
+        return w.scatter_add_(0, index, delta * sign)
+
+    def reconstruct(self, w: torch.Tensor) -> torch.Tensor:
+        sign = self.sign if w.dim() == 1 else self.sign[:, None]
+        return w[self.hash] * sign / self.parts
+
+
+def reconstruct_delta(G, w: torch.Tensor) -> torch.Tensor:
+    if isinstance(G, CountSketch):
+        return G.reconstruct(w)
+    return (G @ w.to(G.dtype)).float()
+
 
 def get_approx_optimal_weights(G: torch.Tensor, 
                                delta: torch.Tensor, 
                                f: int = args.f, 
                                device: torch.device = torch.device('cpu')) -> torch.Tensor:
+    if isinstance(G, CountSketch):
+        return G.sketch(delta.to(device))
     # Ensure G and delta are on the correct device
     G = G.to(device)
     delta = delta.to(device)
     
-    # Perform the matrix operation on the device
-    w = G.T @ delta / f
+    # Perform the matrix operation on the device, bf16 inputs with fp32 output
+    w = (G.T @ delta.to(G.dtype)).float() / f
     return w
 
 def set_all_param_zero(model):
@@ -32,56 +80,147 @@ def set_all_param_zero(model):
             p.zero_()
 
 
+_flat_meta_cache = weakref.WeakKeyDictionary()
+
+
+def get_flat_meta(model):
+    # Trainable params and their (start, numel, shape, stride) in the flattened
+    # vector, computed once per model since none of them change during training.
+    if model not in _flat_meta_cache:
+        params = [p for p in model.parameters() if p.requires_grad]
+        meta, start = [], 0
+        for p in params:
+            meta.append((start, p.numel(), p.shape, p.stride()))
+            start += p.numel()
+        _flat_meta_cache[model] = (params, meta)
+    return _flat_meta_cache[model]
+
+
+def get_flat_views(x_flattern, meta):
+    # Views with each param's own strides: the flat layout follows memory
+    # order, so channels_last weights and their views share one layout and
+    # the foreach kernels see matching strides.
+    return [
+        x_flattern.narrow(0, start, numel).as_strided(shape, stride)
+        for start, numel, shape, stride in meta
+    ]
+
+
 def set_flatten_model_back(model, x_flattern):
     with torch.no_grad():
-        start = 0
-        for p in model.parameters():
-            if not p.requires_grad:
-                continue
-            p_extract = x_flattern[start : (start + p.numel())]
-            p.set_(p_extract.view(p.shape).clone())
-            if p.grad is not None:
-                p.grad.zero_()
-            start += p.numel()
+        params, meta = get_flat_meta(model)
+        # One multi-tensor copy into the existing storage, no per-param clone.
+        # vector_to_parameters would instead alias the params to x_flattern,
+        # which for agents is the server's own flatten_params on device_1.
+        torch._foreach_copy_(params, get_flat_views(x_flattern, meta))
+    model.zero_grad(set_to_none=True)
+
+
+def flatten_like_params(model, tensors) -> torch.Tensor:
+    params, meta = get_flat_meta(model)
+    flat = torch.empty(sum(numel for _, numel, _, _ in meta), device=params[0].device)
+    torch._foreach_copy_(get_flat_views(flat, meta), tensors)
+    return flat
 
 
 def get_flatten_model_param(model):
     with torch.no_grad():
-        return torch.cat(
-            [p.detach().view(-1) for p in model.parameters() if p.requires_grad]
-        )
+        params, _ = get_flat_meta(model)
+        return flatten_like_params(model, [p.detach() for p in params])
 
 
 def get_flatten_model_grad(model) -> torch.Tensor:
     with torch.no_grad():
-        return torch.cat(
-            [p.grad.detach().view(-1) for p in model.parameters() if p.requires_grad]
+        params, _ = get_flat_meta(model)
+        return flatten_like_params(model, [p.grad.detach() for p in params])
+
+
+def to_device(inputs, device, non_blocking=False):
+    # Image batches go channels_last to match the conv models' memory format.
+    if inputs.dim() == 4:
+        return inputs.to(
+            device, memory_format=torch.channels_last, non_blocking=non_blocking
         )
+    return inputs.to(device, non_blocking=non_blocking)
 
 
 def accuracy(output, target):
     # get the index of the max log-probability
     pred = output.data.max(1, keepdim=True)[1]
-    return pred.eq(target.data.view_as(pred)).cpu().float().mean()
+    # Reduce on the device; Metric only syncs when the average is read.
+    return pred.eq(target.data.view_as(pred)).float().mean()
 
 
 class Metric(object):
-    def __init__(self, name):
+    def __init__(self, name, device="cpu"):
         self.name = name
-        self.sum = 0
+        # Accumulate on the device; reading avg is the only host sync.
+        self.sum = torch.zeros((), device=device)
         self.n = 0
 
     def update(self, val):
         if isinstance(val, torch.Tensor):
-            self.sum += val.detach().cpu()
+            self.sum.add_(val.detach())
         else:
-            self.sum += val
+            self.sum.add_(val)
         self.n += 1
 
     @property
-    def avg(self):
+    def mean(self):
+        # Same as avg but left on the device, so reading it does not sync.
         return self.sum / self.n
 
+    @property
+    def avg(self):
+        return self.mean.item()
+
+
+class CUDAPrefetcher:
+    # Copies the next batch to the GPU on a side stream while the current one
+    # is being trained on. Batches are drawn on the calling thread, so the
+    # shuffle order stays fixed by args.seed, and the loader is only iterated
+    # from the first next(), so building an Agent holds no batch.
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.copy_stream = torch.cuda.Stream(device=device)
+        self.batch_idx = -1
+        self.next_batch = None
+
+    def preload(self):
+        try:
+            inputs, targets = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.copy_stream):
+            # The loader pins its batches, so the copies can be non_blocking.
+            self.next_batch = (
+                to_device(inputs, self.device, non_blocking=True),
+                targets.to(self.device, non_blocking=True),
+            )
+            self.copied = torch.cuda.Event()
+            self.copied.record(self.copy_stream)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch_idx == -1:
+            self.loader = iter(self.loader)
+            self.preload()
+        if self.next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(self.copied)
+        inputs, targets = self.next_batch
+        # The tensors were allocated on the copy stream but are used here.
+        inputs.record_stream(current_stream)
+        targets.record_stream(current_stream)
+        self.batch_idx += 1
+        self.preload()
+        return self.batch_idx, (inputs, targets)
+
 
 class Agent:
     def __init__(self, *, model, optimizer, scheduler, criterion, train_loader, device_1, device_2):
@@ -90,30 +229,39 @@ class Agent:
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.train_loader = train_loader
-        self.train_loss = Metric("train_loss")
-        self.train_accuracy = Metric("train_accuracy")
+        self.train_loss = Metric("train_loss", device_1)
+        self.train_accuracy = Metric("train_accuracy", device_1)
         self.device_1 = device_1
         self.device_2 = device_2
         self.batch_idx = 0
         self.epoch = 0
         self.data_generator = self.get_one_train_batch()
-        self.model_grad = torch.zeros_like(get_flatten_model_param(self.model))
-        self.G1 = torch.zeros_like(get_flatten_model_param(self.model)).to(self.device_1)
-        self.G2 = torch.zeros_like(get_flatten_model_param(self.model)).to(self.device_2)
+        self.stream = (
+            torch.cuda.Stream(device=device_1)
+            if torch.device(device_1).type == "cuda"
+            else None
+        )
+        # Per-param views into model_grad so grads can be accumulated in place.
+        self.params, meta = get_flat_meta(self.model)
+        d = sum(numel for _, numel, _, _ in meta)
+        self.model_grad = torch.zeros(d, device=self.device_1)
+        self.model_grad_views = get_flat_views(self.model_grad, meta)
 
     def pull_G(self, server):
-        self.G = server.G
+        # Share the server's sketches by reference instead of copying them.
+        self.G1, self.G2 = server.G1, server.G2
 
     def get_one_train_batch(self):
-        for batch_idx, (inputs, targets) in enumerate(self.train_loader):
-            yield batch_idx, (inputs, targets)
+        if torch.device(self.device_1).type == "cuda":
+            return CUDAPrefetcher(self.train_loader, self.device_1)
+        return enumerate(self.train_loader)
 
     def reset_epoch(self):
         self.data_generator = self.get_one_train_batch()
         self.batch_idx = 0
         self.epoch += 1
-        self.train_loss = Metric("train_loss")
-        self.train_accuracy = Metric("train_accuracy")
+        self.train_loss = Metric("train_loss", self.device_1)
+        self.train_accuracy = Metric("train_accuracy", self.device_1)
 
     def pull_model_from_server(self, server):
         # print("pull_model_from_server")
@@ -133,47 +281,55 @@ class Agent:
 
     def train_k_step_fedavg(self, k: int):
         self.model.train()
-        # Initialize an empty gradient tensor
-        self.model_grad = torch.zeros_like(get_flatten_model_param(self.model))
-        for i in range(k):
-            try:
-                batch_idx, (inputs, targets) = next(self.data_generator)
-            except StopIteration:
-                loss, acc = self.train_loss.avg, self.train_accuracy.avg
-                self.reset_epoch()
-                return loss, acc
-            inputs, targets = inputs.to(self.device_1), targets.to(self.device_1)
-            self.model.zero_grad()
-            outputs = self.model(inputs)
-            loss = self.criterion(outputs, targets)
-            loss.backward()
-            
-            self.model_grad += get_flatten_model_grad(self.model)
-            
-            self.optimizer.step()
-            self.train_loss.update(loss.item())
-            self.train_accuracy.update(accuracy(outputs, targets).item())
+        if self.stream is not None:
+            # Wait for the parameters written by pull_model_from_server.
+            self.stream.wait_stream(torch.cuda.current_stream(self.device_1))
+        # Queue the steps on this agent's own stream so the kernels of several
+        # clients can overlap; the returned metrics stay on the device.
+        with torch.cuda.stream(self.stream):
+            # Reset the gradient accumulator in place
+            self.model_grad.zero_()
+            for i in range(k):
+                try:
+                    batch_idx, (inputs, targets) = next(self.data_generator)
+                except StopIteration:
+                    loss, acc = self.train_loss.mean, self.train_accuracy.mean
+                    self.reset_epoch()
+                    return loss, acc
+                inputs, targets = to_device(inputs, self.device_1), targets.to(self.device_1)
+                self.model.zero_grad(set_to_none=True)
+                outputs = self.model(inputs)
+                loss = self.criterion(outputs, targets)
+                loss.backward()
+                
+                torch._foreach_add_(self.model_grad_views, [p.grad for p in self.params])
+                
+                self.optimizer.step()
+                self.train_loss.update(loss)
+                self.train_accuracy.update(accuracy(outputs, targets))
     
-        return self.train_loss.avg, self.train_accuracy.avg
+            return self.train_loss.mean, self.train_accuracy.mean
 
     def eval(self, test_dataloader) -> tuple[float, float]:
         self.model.eval()
-        val_accuracy = Metric("val_accuracy")
-        val_loss = Metric("val_loss")
+        val_accuracy = Metric("val_accuracy", self.device_1)
+        val_loss = Metric("val_loss", self.device_1)
         for batch_idx, (inputs, targets) in enumerate(test_dataloader):
-            inputs, targets = inputs.to(self.device_1), targets.to(self.device_1)
+            inputs, targets = to_device(inputs, self.device_1), targets.to(self.device_1)
             outputs = self.model(inputs)
-            val_accuracy.update(accuracy(outputs, targets).item())
-            val_loss.update(self.criterion(outputs, targets).item())
+            val_accuracy.update(accuracy(outputs, targets))
+            val_loss.update(self.criterion(outputs, targets))
         return val_loss.avg, val_accuracy.avg
 
 
 def local_update_selected_clients_fedavg(clients: list[Agent], server, local_update):
-    train_loss_sum, train_acc_sum = 0, 0
+    # Issue every client's steps on its own stream first, then sync once.
+    results = [client.train_k_step_fedavg(k=local_update) for client in clients]
     for client in clients:
-        train_loss, train_acc = client.train_k_step_fedavg(k=local_update)
-        train_loss_sum += train_loss
-        train_acc_sum += train_acc
+        if client.stream is not None:
+            client.stream.synchronize()
+    train_loss_sum = sum(train_loss.item() for train_loss, _ in results)
+    train_acc_sum = sum(train_acc.item() for _, train_acc in results)
     return train_loss_sum / len(clients), train_acc_sum / len(clients)
 
 
@@ -181,95 +337,136 @@ class Server:
     def __init__(self, *, model, criterion, device_1, device_2, device='cpu'):
         self.model = model.to(device)
         self.device = device
-        self.flatten_params = get_flatten_model_param(self.model).to(self.device)
         self.criterion = criterion
         self.device_1 = device_1
         self.device_2 = device_2
+        # Aggregation runs on device_1; self.model on self.device is only a
+        # copy of flatten_params for evaluation.
+        self.flatten_params = get_flatten_model_param(self.model).to(self.device_1)
         self.num_arb_participation = 0
         self.num_uni_participation = 0
         self.momentum = self.flatten_params.clone().zero_()
-        d = get_flatten_model_param(self.model).size(0)
-        self.G1 = generate_gaussian_matrix(d = d,
-                                           device=self.device_1)
-        self.G2 = generate_gaussian_matrix(d = d,
-                                           device=self.device_2)
-        # print(f'G1 shape: {self.G1.shape}, G1 device: {self.G1.device}')
-        # print(f'G2 shape: {self.G2.shape}, G2 device: {self.G2.device}')
-                
+        d = self.flatten_params.size(0)
+        # One generator per GPU so G1/G2 can be redrawn in place every round.
+        self.gen1 = torch.Generator(device=self.device_1).manual_seed(args.seed)
+        self.gen2 = torch.Generator(device=self.device_2).manual_seed(args.seed + 1)
+        # Side stream for the peer copy of the deltas to device_2, only when
+        # fedavg actually copies between two GPUs. A cross-device copy runs on
+        # the source device's current stream, so it lives on device_1.
+        self.copy_stream = (
+            torch.cuda.Stream(device=self.device_1)
+            if args.algo == "fedavg"
+            and torch.device(self.device_1).type == "cuda"
+            and torch.device(self.device_1) != torch.device(self.device_2)
+            else None
+        )
+        if args.sketch == "countsketch":
+            self.G1 = CountSketch(d, device=self.device_1, generator=self.gen1)
+            self.G2 = CountSketch(d, device=self.device_2, generator=self.gen2)
+        else:
+            self.G1 = generate_gaussian_matrix(d = d,
+                                               device=self.device_1,
+                                               generator=self.gen1)
+            self.G2 = generate_gaussian_matrix(d = d,
+                                               device=self.device_2,
+                                               generator=self.gen2)
+            # print(f'G1 shape: {self.G1.shape}, G1 device: {self.G1.device}')
+            # print(f'G2 shape: {self.G2.shape}, G2 device: {self.G2.device}')
+            if args.debug_mse:
+                # A GEMM plus a host sync, so only when debugging the sketch
+                self.check_sketch_precision()
+
+    def check_sketch_precision(self, n: int = None):
+        # Compare sketching with a bf16-stored G against the fp32 G it was
+        # rounded from. Both come from one fp32 draw, so the gap is the cost of
+        # storing G in bf16. n defaults to about 2**24 entries of G, i.e. one
+        # full block of G rows, without materializing a full fp32 copy of G.
+        cols = self.G1.size(1)
+        n = min(self.G1.size(0), n or max(1, 2**24 // cols))
+        gen = torch.Generator(device=self.device_1).manual_seed(args.seed)
+        G_fp32 = torch.randn(n, cols, device=self.device_1, generator=gen)
+        G_bf16 = G_fp32.to(torch.bfloat16)
+        delta = torch.randn(n, device=self.device_1, generator=gen)
+        w_bf16 = get_approx_optimal_weights(G=G_bf16, delta=delta, device=self.device_1)
+        Gw_bf16 = reconstruct_delta(G_bf16, w_bf16)
+        Gw_fp32 = G_fp32 @ (G_fp32.T @ delta / args.f)
+        print('bf16 vs fp32 sketch MSE:', torch.mean((Gw_bf16 - Gw_fp32) ** 2).item())
+
 
     def avg_clients(self, clients: list[Agent]):
         # print('Investigating Pre-existing Space Consumption:')
         # print(torch.cuda.memory_summary())
         if args.algo == "fedavg":
-            for i, client in enumerate(clients):
-                print('Client:', i+1, end=' ', flush=True)
-                
-                # print(f"[GPU 1] Memory before delta move: {torch.cuda.memory_allocated(self.device_1)}")
-                # print(f"[GPU 2] Memory before delta move: {torch.cuda.memory_allocated(self.device_2)}")
-                
-                # Move deltas to both GPUs
-                delta_1 = (client.model_grad).to(self.device_1)
-                delta_2 = delta_1.clone().to(self.device_2)
-                
-                # print(f"[GPU 1] Memory after delta move: {torch.cuda.memory_allocated(self.device_1)}")
-                # print(f"[GPU 2] Memory after delta move: {torch.cuda.memory_allocated(self.device_2)}")
-                
-                # generate ws
-                w_1 = get_approx_optimal_weights(G = self.G1,
-                                                 delta=delta_1,
-                                                 device=self.device_1)
-                w_2 = get_approx_optimal_weights(G = self.G2,
-                                                 delta=delta_2,
-                                                 device=self.device_2)
-                
-                # print(f"[GPU 1] Memory after generating ws: {torch.cuda.memory_allocated(self.device_1)}")
-                # print(f"[GPU 2] Memory after generating ws: {torch.cuda.memory_allocated(self.device_2)}")
+            # Stack the client deltas as columns so each sketch GEMM streams
+            # G1/G2 once per round instead of once per client.
+            delta_1 = torch.stack(
+                [client.model_grad for client in clients], dim=1
+            ).to(self.device_1)
+
+            # Copy the deltas to device_2 once, on a device_1 side stream, so the
+            # peer copy overlaps with the G1 GEMM on device_1's main stream
+            if self.copy_stream is None:
+                delta_2 = delta_1.to(self.device_2)
+            else:
+                self.copy_stream.wait_stream(torch.cuda.current_stream(self.device_1))
+                with torch.cuda.stream(self.copy_stream):
+                    delta_2 = delta_1.to(self.device_2, non_blocking=True)
+                    copied = torch.cuda.Event()
+                    copied.record(self.copy_stream)
+                # delta_1 is read by the side stream while the main stream moves on
+                delta_1.record_stream(self.copy_stream)
+
+            # generate ws
+            w_1 = get_approx_optimal_weights(G = self.G1,
+                                             delta=delta_1,
+                                             device=self.device_1)
+            if self.copy_stream is not None:
+                torch.cuda.current_stream(self.device_2).wait_event(copied)
+            w_2 = get_approx_optimal_weights(G = self.G2,
+                                             delta=delta_2,
+                                             device=self.device_2)
+
+            # in actual set up, ws will be concatenated and sent to the server here
+
+            # Reconstruct d by G @ w and sum d0_hat and d1_hat
+            Gw_1 = reconstruct_delta(self.G1, w_1)
+            Gw_2 = reconstruct_delta(self.G2, w_2)
+            Gw = Gw_1 + Gw_2.to(self.device_1)
+
+            if args.debug_mse:
+                # Per-client reconstruction error, one column at a time so only a
+                # d-sized temporary is live; read back once at the end of the round
+                mse = torch.stack(
+                    [F.mse_loss(Gw[:, c], delta_1[:, c]) for c in range(Gw.size(1))]
+                )
 
+            # sum over clients, then a single fused axpy for the update
+            Gw_sum = Gw.sum(dim=1)
 
-                # in actual set up, ws will be concatenated and sent to the server here
-                
-                # Reconstruct d by G @ w
-                Gw_1 = self.G1 @ w_1
-                Gw_2 = self.G2 @ w_2
-                
-                # print(f"[GPU 1] Memory after reconstructing Gw_1 and Gw_2: {torch.cuda.memory_allocated(self.device_1)}")
-                # print(f"[GPU 2] Memory after reconstructing Gw_1 and Gw_2: {torch.cuda.memory_allocated(self.device_2)}")
-                
-                Gw2_on_device_1 = Gw_2.to(self.device_1)
+            self.flatten_params.add_(Gw_sum, alpha=-args.lr / len(clients))
 
-                # sum d0_hat and d1_hat
-                Gw = Gw_1 + Gw2_on_device_1
-                
-                mse = torch.mean((delta_1 - Gw) ** 2)
-                print('MSE:', mse)
-                
-                # move to cpu & release CUDA space
-                Gw_on_cpu = Gw.to(self.device)
-                del Gw, mse, Gw_1, Gw_2, Gw2_on_device_1, w_1, w_2
-                torch.cuda.empty_cache()
-                
-                # print(f"[GPU 1] Memory after deletion and empty cache: {torch.cuda.memory_allocated(self.device_1)}")
-                # print(f"[GPU 2] Memory after deletion and empty cache: {torch.cuda.memory_allocated(self.device_2)}")
-                
-                self.flatten_params -= Gw_on_cpu.mul_(args.lr / len(clients))
-                
-            set_flatten_model_back(self.model, self.flatten_params)
+            if args.debug_mse:
+                print('MSE:', mse.tolist())
         
-        d = get_flatten_model_param(self.model).size(0)
-        self.G1 = generate_gaussian_matrix(d = d,
-                                           device=self.device_1)
-        self.G2 = generate_gaussian_matrix(d = d,
-                                           device=self.device_2)
+        # Redraw the sketches into the existing buffers instead of reallocating.
+        if isinstance(self.G1, CountSketch):
+            self.G1.redraw()
+            self.G2.redraw()
+        else:
+            self.G1.normal_(generator=self.gen1)
+            self.G2.normal_(generator=self.gen2)
 
     def eval(self, test_dataloader) -> tuple[float, float]:
+        # Only copy flatten_params off device_1 when the eval model is needed.
+        set_flatten_model_back(self.model, self.flatten_params.to(self.device))
         self.model.eval()
-        val_accuracy = Metric("val_accuracy")
-        val_loss = Metric("val_loss")
+        val_accuracy = Metric("val_accuracy", self.device)
+        val_loss = Metric("val_loss", self.device)
         for batch_idx, (inputs, targets) in enumerate(test_dataloader):
-            inputs, targets = inputs.to(self.device), targets.to(self.device)
+            inputs, targets = to_device(inputs, self.device), targets.to(self.device)
             outputs = self.model(inputs)
-            val_accuracy.update(accuracy(outputs, targets).item())
-            val_loss.update(self.criterion(outputs, targets).item())
+            val_accuracy.update(accuracy(outputs, targets))
+            val_loss.update(self.criterion(outputs, targets))
         return val_loss.avg, val_accuracy.avg
 
     # Determine the sampling method by q
@@ -314,40 +511,32 @@ def partition(dataset, n_nodes, data_dirichlet_alpha):
     )
     sum_prob_per_label = np.sum(label_distributions_each_node, axis=0)
 
-    indices_per_label = []
-    for i in range(min_label, max_label + 1):
-        indices_per_label.append([j for j in range(len(labels)) if labels[j] == i])
+    indices_per_label = label_buckets(dataset, labels, min_label, max_label)
 
-    start_index_per_label = np.zeros(num_labels, dtype="int64")
+    # End offset into indices_per_label[i] for every (node, label) at once.
+    end_index_per_node = np.round(
+        np.array([len(indices) for indices in indices_per_label])
+        * np.cumsum(label_distributions_each_node, axis=0)
+        / sum_prob_per_label
+    ).astype("int64")
+
+    start_index_per_node = np.concatenate(
+        [np.zeros((1, num_labels), dtype="int64"), end_index_per_node[:-1]], axis=0
+    )
+    counts = end_index_per_node - start_index_per_node
+    # Allocate each node's index array once and fill it slice by slice.
     for n in range(n_nodes):
+        dict_users[n] = np.empty(counts[n].sum(), dtype="int64")
+        offset = 0
         for i in range(num_labels):
-            end_index = int(
-                np.round(
-                    len(indices_per_label[i])
-                    * np.sum(label_distributions_each_node[: n + 1, i])
-                    / sum_prob_per_label[i]
-                )
-            )
-            dict_users[n] = np.concatenate(
-                (
-                    dict_users[n],
-                    np.array(
-                        indices_per_label[i][start_index_per_label[i] : end_index],
-                        dtype="int64",
-                    ),
-                ),
-                axis=0,
-            )
-            start_index_per_label[i] = end_index
+            start_index, end_index = start_index_per_node[n, i], end_index_per_node[n, i]
+            dict_users[n][offset : offset + counts[n, i]] = indices_per_label[i][
+                start_index:end_index
+            ]
+            offset += counts[n, i]
 
     actual_label_distributions_each_node = [
-        np.array(
-            [
-                len([j for j in labels[dict_users[n]] if j == i])
-                for i in range(min_label, max_label + 1)
-            ],
-            dtype="int64",
-        )
+        np.bincount(labels[dict_users[n]] - min_label, minlength=num_labels)
         / len(dict_users[n])
         for n in range(n_nodes)
     ]
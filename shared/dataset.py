@@ -130,6 +130,23 @@ class ShakeSpeare(Dataset):
             exit("The test dataset do not have dic_users!")
 
 
+def label_buckets(dataset, labels, min_label, max_label):
+    # Sample indices grouped by label, cached on the dataset itself so repeated
+    # partitions of one dataset skip the sort without re-reading all labels.
+    key = (len(labels), min_label, max_label)
+    cached = getattr(dataset, "_label_buckets", None)
+    if cached is None or cached[0] != key:
+        # One stable sort instead of a scan per label.
+        order = np.argsort(labels, kind="stable")
+        boundaries = np.searchsorted(labels[order], np.arange(min_label, max_label + 2))
+        buckets = tuple(
+            order[boundaries[i] : boundaries[i + 1]]
+            for i in range(max_label - min_label + 1)
+        )
+        dataset._label_buckets = cached = (key, buckets)
+    return cached[1]
+
+
 def batch_data(data, batch_size, seed):
     """
     data is a dict := {'x': [numpy array], 'y': [numpy array]} (on one client)